@@ -6,8 +6,8 @@
 #
 # Aug-2020, Pat Welch, pat@mousebrains.com
 
+import sys
 import threading
-import queue
 import logging
 import time
 import os
@@ -17,10 +17,31 @@ import ctypes
 import ctypes.util
 from errno import EINTR
 from io import FileIO
-from fcntl import ioctl
-from termios import FIONREAD
 import struct
 import select
+from SPSCQueue import SPSCQueue
+
+_HDR_STRUCT = struct.Struct("iIII") # struct inotify_event header, wd, mask, cookie, len
+_HDR_SIZE = _HDR_STRUCT.size
+_EVENT_MAX = _HDR_SIZE + 255 + 1 # Largest possible event, header + NAME_MAX + NUL
+_BUFFER_SIZE = 4096 * _EVENT_MAX # Read buffer size
+
+def scanTree(path:str, prune=None):
+    """ Recursively yield the os.DirEntry objects below path, without following symlinks
+
+    Directories for which prune(entry.path) is true are skipped, along with their trees.
+    """
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if prune is not None and prune(entry.path): continue
+                    yield entry
+                    yield from scanTree(entry.path, prune)
+                else:
+                    yield entry
+    except OSError: # Like os.walk, ignore directories which can not be scanned
+        pass
 
 class Flags(IntFlag):
     ACCESS        = 0x00000001 # File was accessed
@@ -68,30 +89,49 @@ class Flags(IntFlag):
     def __init__(self, mask:int) -> None:
         self.raw = mask
 
+# Raw integer masks used when dispatching events in INotify.__procBuffer
+_ISDIR = int(Flags.ISDIR)
+_ADDED = int(Flags.CREATE | Flags.MOVED_TO)
+_REMOVED = int(Flags.DELETE | Flags.DELETE_SELF | Flags.MOVED_FROM)
+_IGNORED = int(Flags.IGNORED)
+
 class Event:
-    def __init__(self, t:float, path:str, flags:Flags) -> None:
+    __slots__ = ("t", "path", "mask")
+
+    def __init__(self, t:float, path:str, mask:int) -> None:
         self.t = t
         self.path = path
-        self.flags = flags
+        self.mask = mask # Raw integer mask, Flags are only built when asked for
+
+    @property
+    def flags(self) -> Flags:
+        return Flags(self.mask)
 
     def __repr__(self) -> str:
         return self.path + " " + str(self.flags) + " " + str(self.t)
 
 class INotify(threading.Thread):
-    def __init__(self, logger:logging.Logger, inheritable:bool=False, nonBlocking:bool=False):
+    def __init__(self, logger:logging.Logger, inheritable:bool=False):
         super().__init__(daemon=True)
         self.name = "INotify"
         self.__logger = logger
-        self.__queue = queue.Queue()
+        self.__queue = SPSCQueue() # Only one thread may get events
         self.__watches = {}
         self.__paths = {}
         self.__recursive = {}
         self.__mask = {}
+        self.__prune = {}
+        # What os.fsencode uses, looked up once rather than for every watch added
+        self.__fsEncoding = sys.getfilesystemencoding()
+        self.__fsErrors = sys.getfilesystemencodeerrors()
         try:
             libfn = ctypes.util.find_library("c")
             self.__libc = ctypes.CDLL(libfn)
-            flags = ((not inheritable) * os.O_CLOEXEC) | (nonBlocking * os.O_NONBLOCK)
+            # Always non-blocking so run can drain everything pending after select
+            flags = ((not inheritable) * os.O_CLOEXEC) | os.O_NONBLOCK
             self.__fp = FileIO(self.__callLibC("inotify_init1", flags), mode='rb')
+            self.__epoll = select.epoll()
+            self.__epoll.register(self.__fp.fileno(), select.EPOLLIN)
         except:
             logger.exception("Unable to find libc library filename")
 
@@ -111,91 +151,116 @@ class INotify(threading.Thread):
     def get(self, timeout=None) -> Event:
         return self.__queue.get(timeout=timeout)
 
+    def get_nowait(self) -> Event:
+        return self.__queue.get_nowait()
+
     def task_done(self) -> None:
         self.__queue.task_done()
 
-    def __addWatch(self, path:str, recursive:bool, mask:Flags) -> None:
+    def __addWatch(self, path:str, recursive:bool, mask:Flags, isDir:bool, prune) -> None:
         if path in self.__watches: return
         try:
-            wd = self.__callLibC("inotify_add_watch", self.__fp.fileno(), os.fsencode(path), mask)
+            wd = self.__callLibC("inotify_add_watch", self.__fp.fileno(),
+                    path.encode(self.__fsEncoding, self.__fsErrors), mask)
             self.__watches[path] = wd
-            self.__paths[wd] = path
-            self.__recursive[wd] = recursive and os.path.isdir(path)
+            # The path and the prefix for names inside of it, so events can use concatenation
+            self.__paths[wd] = (path, path if path.endswith(os.sep) else (path + os.sep))
+            self.__recursive[wd] = recursive and isDir
             self.__mask[wd] = mask
+            self.__prune[wd] = prune
         except:
-            logger.exception("Error adding a watch for %s", path) 
+            self.__logger.exception("Error adding a watch for %s", path)
+
+    def __forgetWatch(self, wd:int) -> bool:
+        """ Drop the bookkeeping for wd, returning if it was recursive """
+        (path, prefix) = self.__paths.pop(wd)
+        if self.__watches.get(path) == wd: del self.__watches[path]
+        recursive = self.__recursive.pop(wd)
+        del self.__mask[wd]
+        del self.__prune[wd]
+        return recursive
 
     def __rmWatch(self, path:str) -> bool:
         if path not in self.__watches: return False
         wd = self.__watches[path]
-        recursive = self.__recursive[wd]
-        del self.__watches[path]
-        del self.__paths[wd]
-        del self.__recursive[wd]
-        del self.__mask[wd]
+        recursive = self.__forgetWatch(wd)
         try:
             self.__callLibC("inotify_rm_watch", self.__fp.fileno(), wd)
         except:
-            logger.exception("Error removing a watch for %s", path) 
+            self.__logger.exception("Error removing a watch for %s", path)
         return recursive
 
 
-    def add(self, path:str, recursive:bool=True, mask:Flags=Flags.ALL_EVENTS) -> None:
-        self.__addWatch(path, recursive, mask)
-        if (not recursive) or (not os.path.isdir(path)): return
-        for (root, dirs, files) in os.walk(path):
-            for item in dirs:
-                self.__addWatch(os.path.join(root, item), recursive, mask)
+    def add(self, path:str, recursive:bool=True, mask:Flags=Flags.ALL_EVENTS, prune=None) -> None:
+        """ When recursive, directories for which prune(path) is true are not watched """
+        isDir = os.path.isdir(path)
+        self.__addWatch(path, recursive, mask, isDir, prune)
+        if (not recursive) or (not isDir): return
+        for entry in scanTree(path, prune):
+            if entry.is_dir(follow_symlinks=False): # From scandir, so no stat
+                self.__addWatch(entry.path, recursive, mask, True, prune)
 
     def rm(self, path:str) -> None:
         if not self.__rmWatch(path): return
-        toRemove = []
-        for key in self.__watches:
-            if key.find(path) == 0:
-                toRemove.append(key)
-
-        for key in toRemove:
+        prefix = path.rstrip(os.sep) + os.sep # So /a/bb is not treated as being below /a/b
+        for key in [k for k in self.__watches if k.startswith(prefix)]:
             self.__rmWatch(key)
 
     def run(self) -> None: # Called on start
         logger = self.__logger
         logger.info("Starting")
-        buffer = bytearray()
+        buffer = bytearray(_BUFFER_SIZE) # Allocated once and reused for every read
+        mv = memoryview(buffer)
+        tail = 0 # Number of unprocessed bytes at the start of buffer
         fp = self.__fp
+        epoll = self.__epoll
         while True:
-            (rd, wrt, err) = select.select((fp,), (), ())
-            nAvail = ctypes.c_int()
-            ioctl(fp, FIONREAD, nAvail)
-            buffer = self.__procBuffer(buffer + fp.read(nAvail.value))
-
-    def __procBuffer(self, buffer:bytearray) -> bytearray:
-        hdrFormat = "iIII"
-        hdrSize = struct.calcsize(hdrFormat)
+            epoll.poll() # Wait for events, the registration persists between calls
+            while True: # Drain the non-blocking fd
+                n = fp.readinto(mv[tail:])
+                if not n: break # None when nothing is left to read
+                nBytes = tail + n
+                offset = self.__procBuffer(mv, nBytes)
+                tail = nBytes - offset
+                if tail: buffer[0:tail] = mv[offset:nBytes] # Move the partial event to the front
+
+    def __procBuffer(self, buffer:memoryview, nBytes:int) -> int:
+        """ Process the events in buffer[0:nBytes] and return how many bytes were consumed """
         t = time.time()
-        while len(buffer) >= hdrSize:
-            (wd, mask, cookie, n) = struct.unpack_from(hdrFormat, buffer[0:hdrSize])
-            if wd in self.__paths:
-                path = self.__paths[wd]
-                if n > 0:
-                    name = buffer[hdrSize:(hdrSize+n)]
-                    index = name.find(b'\x00')
-                    if index >= 0:
-                        name = name[0:index]
-                    name = str(name, "UTF-8")
-                    path = os.path.join(path, name)
-                evt = Event(t, path, Flags(mask))
-                self.__queue.put(evt)
-                if evt.flags.ISDIR in evt.flags:
-                    if (evt.flags.CREATE in evt.flags) or (evt.flags.MOVED_TO in evt.flags):
-                        if self.__recursive[wd]:
-                            self.add(evt.path, True, self.__mask[wd])
-                    elif (evt.flags.DELETE in evt.flags) or \
-                            (evt.flags.DELETE_SELF in evt.flags) or \
-                            (evt.flags.MOVED_FROM in evt.flags):
-                        self.rm(evt.path)
-
-            buffer = buffer[(hdrSize+n):]
-        return buffer
+        offset = 0 # Cursor into buffer, so the buffer is not copied for each event
+        pending = [] # Events to be put into the queue in one batch
+        while (nBytes - offset) >= _HDR_SIZE:
+            (wd, mask, cookie, n) = _HDR_STRUCT.unpack_from(buffer, offset)
+            if n == 0: # A run of events without names, unpack the headers in one pass
+                end = offset + _HDR_SIZE * ((nBytes - offset) // _HDR_SIZE)
+                for (wd, mask, cookie, n) in _HDR_STRUCT.iter_unpack(buffer[offset:end]):
+                    if n: break # Let the general case handle it
+                    self.__procEvent(pending, t, wd, mask, None)
+                    offset += _HDR_SIZE
+                continue
+            if (offset + _HDR_SIZE + n) > nBytes: break # Partial event
+            name = bytes(buffer[(offset+_HDR_SIZE):(offset+_HDR_SIZE+n)]).split(b'\x00', 1)[0]
+            self.__procEvent(pending, t, wd, mask, name)
+            offset += _HDR_SIZE + n
+        self.__queue.putMany(pending) # One wakeup for the whole batch
+        return offset
+
+    def __procEvent(self, pending:list, t:float, wd:int, mask:int, name:bytes) -> None:
+        if wd not in self.__paths: return
+        (path, prefix) = self.__paths[wd]
+        if name is not None:
+            path = prefix + name.decode("UTF-8", "replace")
+        pending.append(Event(t, path, mask))
+        if mask & _ISDIR: # Test the raw integer, not the Flags object
+            if mask & _ADDED:
+                if self.__recursive[wd]:
+                    prune = self.__prune[wd]
+                    if prune is None or not prune(path):
+                        self.add(path, True, self.__mask[wd], prune)
+            elif mask & _REMOVED:
+                self.rm(path)
+        if (mask & _IGNORED) and (wd in self.__paths): # The kernel dropped wd, so a new directory at path can be watched again
+            self.__forgetWatch(wd)
 
 if __name__ == "__main__":
     import argparse
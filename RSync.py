@@ -9,6 +9,7 @@ import argparse
 import logging
 import queue
 import subprocess
+from SPSCQueue import SPSCQueue
 
 class RSync(threading.Thread):
     def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
@@ -16,7 +17,8 @@ class RSync(threading.Thread):
         self.name = "RSync"
         self.__args = args
         self.__logger = logger
-        self.__queue = queue.Queue() # Incoming actions to do
+        self.__queue = SPSCQueue() # Incoming actions to do, run is the only consumer
+        self.__cmdPrefix = self.__mkCmdPrefix(args) # args does not change, so build once
 
     @staticmethod
     def addArgs(parser:argparse.ArgumentParser) -> None:
@@ -33,14 +35,30 @@ class RSync(threading.Thread):
                 help="Should the actual rsync command be run?")
         grp.add_argument("--rsyncExclude", type=str, action="append", metavar="pattern",
                 help="arguments to rsync's --exclude option")
+        grp.add_argument("--rsyncMaxSources", type=int, default=256, metavar="count",
+                help="Maximum number of sources to merge into a single rsync command")
+        RSync.addControlArgs(grp, "--rsyncControlPath", "--rsyncControlPersist")
+
+    @staticmethod
+    def addControlArgs(parser:argparse.ArgumentParser, pathName:str, persistName:str) -> None:
+        """ ssh multiplexing options, shared with scripts which run rsync themselves """
+        parser.add_argument(pathName, type=str, metavar="~/.ssh/rsync-%C",
+                help="Reuse one ssh connection to the target via this ControlPath socket")
+        parser.add_argument(persistName, type=str, default="10m", metavar="10m",
+                help="How long the shared ssh connection stays open after the last rsync")
+
+    @staticmethod
+    def rshArgs(controlPath:str, controlPersist:str) -> tuple:
+        """ rsync --rsh arguments for ssh multiplexing, so only the first rsync connects """
+        if controlPath is None: return ()
+        return ("--rsh", "ssh -o ControlMaster=auto -o ControlPath={} -o ControlPersist={}".format(
+            controlPath, controlPersist))
 
     def put(self, sources:tuple) -> None:
         self.__queue.put(sources)
 
-    def __doit(self, sources:tuple) -> bool:
-        args = self.__args
-        logger = self.__logger
-        target = args.rsyncTarget
+    @staticmethod
+    def __mkCmdPrefix(args:argparse.ArgumentParser) -> tuple:
         cmd = [args.rsyncCmd,
                 "--archive",
                 "--delete-delay",
@@ -50,6 +68,8 @@ class RSync(threading.Thread):
                 "--chmod",
                 args.rsyncchmod]
 
+        cmd.extend(RSync.rshArgs(args.rsyncControlPath, args.rsyncControlPersist))
+
         if args.rsyncOpt is not None:
             cmd.extend(args.rsyncOpt)
 
@@ -58,7 +78,14 @@ class RSync(threading.Thread):
                 cmd.append("--exclude")
                 cmd.append(item)
 
-        cmd.extend(list(sources))
+        return tuple(cmd)
+
+    def __doit(self, sources:tuple) -> bool:
+        args = self.__args
+        logger = self.__logger
+        target = args.rsyncTarget
+        cmd = list(self.__cmdPrefix)
+        cmd.extend(sources)
         cmd.append(target)
         logger.info("cmd %s", cmd)
         if args.rsyncDryRun: 
@@ -84,16 +111,26 @@ class RSync(threading.Thread):
 
     def run(self) -> None:
         logger = self.__logger
-        queue = self.__queue
+        q = self.__queue
+        maxSources = self.__args.rsyncMaxSources
         logger.info("Starting")
         while True:
-            sources = queue.get()
+            sources = dict.fromkeys(q.get()) # Ordered and without duplicates
+            nItems = 1
+            while len(sources) < maxSources: # Merge queued requests into one rsync
+                try:
+                    sources.update(dict.fromkeys(q.get_nowait()))
+                    nItems += 1
+                except queue.Empty:
+                    break
+            sources = tuple(sources)
             logger.info("Sources %s", sources)
             try:
                 self.__doit(sources)
             except:
                 logger.exception("Error executing rsync for %s", sources)
-            queue.task_done()
+            for i in range(nItems):
+                q.task_done()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
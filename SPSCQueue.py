@@ -0,0 +1,76 @@
+#
+# A single consumer queue built on collections.deque,
+# deque's append and popleft are thread safe, so a threading.Event is
+# only needed to wake up the consumer when the deque is empty.
+#
+# Any number of threads may put, but only one thread may get.
+# The API is the subset of queue.Queue used by these scripts.
+#
+# Oct-2026
+
+import collections
+import queue
+import threading
+import time
+
+class SPSCQueue:
+    def __init__(self) -> None:
+        self.__items = collections.deque()
+        self.__ready = threading.Event() # Set when items may be available
+        self.__finished = threading.Condition() # For task_done/join bookkeeping
+        self.__unfinished = 0
+
+    def put(self, item) -> None:
+        with self.__finished:
+            self.__unfinished += 1
+        self.__items.append(item)
+        if not self.__ready.is_set(): self.__ready.set()
+
+    def putMany(self, items:list) -> None:
+        """ Put all of items with a single wakeup of the consumer """
+        if not items: return
+        with self.__finished:
+            self.__unfinished += len(items)
+        self.__items.extend(items)
+        if not self.__ready.is_set(): self.__ready.set()
+
+    def get(self, block:bool=True, timeout:float=None):
+        """ Only one thread may call get, raises queue.Empty like queue.Queue.get """
+        items = self.__items
+        ready = self.__ready
+        deadline = None if timeout is None else (time.monotonic() + timeout)
+        while True:
+            try:
+                return items.popleft()
+            except IndexError:
+                pass
+            ready.clear()
+            if items: continue # A put happened before the clear
+            if not block: raise queue.Empty
+            if deadline is None:
+                ready.wait()
+            else:
+                dt = deadline - time.monotonic()
+                if dt <= 0 or not ready.wait(dt):
+                    if items: continue
+                    raise queue.Empty
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def empty(self) -> bool:
+        return not self.__items
+
+    def task_done(self) -> None:
+        with self.__finished:
+            if self.__unfinished <= 0:
+                raise ValueError("task_done() called too many times")
+            self.__unfinished -= 1
+            if self.__unfinished == 0:
+                self.__finished.notify_all()
+
+    def join(self) -> None:
+        """ Wait until every item put has been marked done """
+        with self.__finished:
+            while self.__unfinished:
+                self.__finished.wait()
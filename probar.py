@@ -11,7 +11,6 @@
 # March-2019, Pat Welch, pat@mousebrains.com
 
 import sys
-import shutil
 import time
 import os
 import os.path
@@ -20,12 +19,40 @@ import logging
 import logging.handlers
 import threading
 import queue
-import subprocess
 import getpass
 import socket
 import re
 import io
 import random
+from collections import defaultdict
+import INotify
+from SPSCQueue import SPSCQueue
+
+def fastCopy(src, tgt): # Copy src to tgt inside the kernel, like shutil.copyfile
+  ifd = os.open(src, os.O_RDONLY)
+  try:
+    ofd = os.open(tgt, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+      remaining = os.fstat(ifd).st_size
+      qRange = hasattr(os, 'copy_file_range') # Python >= 3.8
+      while remaining > 0:
+        if qRange:
+          try:
+            n = os.copy_file_range(ifd, ofd, remaining)
+          except OSError: # Not supported for this kernel/filesystem, so fall back to sendfile
+            n = 0
+          if n == 0: # Some filesystems copy nothing, so let sendfile decide if src was truncated
+            qRange = False
+            continue
+        else:
+          n = os.sendfile(ofd, ifd, None, remaining)
+          if n == 0: # src was truncated
+            break
+        remaining -= n
+    finally:
+      os.close(ofd)
+  finally:
+    os.close(ifd)
 
 class MyBaseThread(threading.Thread):
   def __init__(self, name, logger, qExcept):
@@ -50,34 +77,30 @@ class Historical(MyBaseThread):
     MyBaseThread.__init__(self, 'Hist(' + gld + ')', logger, qExcept)
     self.gld = gld
     self.args = args
-    self.queue = queue.Queue()
+    self.queue = SPSCQueue() # runMain is the only consumer
 
   def put(self, item):
     self.queue.put(item)
 
   def __initialize__(self):
     self.index = 0
-    a = {}
-    for root, dirs, files in os.walk(os.path.join(self.args.historical, self.gld)):
-      for fn in files:
-        (seq, suffix) = os.path.splitext(fn)
-        if seq not in a:
-          a[seq] = []
-        a[seq].append(os.path.join(root, fn))
-
-    self.files = []
-    for key in sorted(a):
-      self.files.append(a[key])
+    a = defaultdict(list)
+    for entry in INotify.scanTree(os.path.join(self.args.historical, self.gld)):
+      if entry.is_dir(): # Uses the type information cached by scandir, no stat
+        continue
+      (seq, suffix) = os.path.splitext(entry.name)
+      a[seq].append(entry.path)
+
+    self.files = [a[key] for key in sorted(a)]
 
   def __initDirs__(self):
     self.tgt = os.path.join(self.args.toGlider, self.gld, 'from-glider')
     if not os.path.isdir(self.tgt):
       os.makedirs(self.tgt)
-    for root, dirs, files in os.walk(self.tgt):
-      for fn in files:
-        fn = os.path.join(root, fn)
-        self.logger.debug('Removing %s', fn)
-        os.unlink(fn)
+    for entry in INotify.scanTree(self.tgt):
+      if not entry.is_dir(follow_symlinks=False):
+        self.logger.debug('Removing %s', entry.path)
+        os.unlink(entry.path)
 
   def __copyNext__(self, delayInit, sigmaInit): 
     index = self.index
@@ -86,7 +109,7 @@ class Historical(MyBaseThread):
       self.__delay__(delayInit, sigmaInit)
       for fn in self.files[index]:
         self.logger.debug('Copy %s into %s', fn, name)
-        shutil.copyfile(fn, os.path.join(name, os.path.basename(fn)))
+        fastCopy(fn, os.path.join(name, os.path.basename(fn)))
         self.__delay__(self.args.delayIntra, self.args.delayIntraSigma)
       self.index += 1
 
@@ -118,52 +141,48 @@ class Historical(MyBaseThread):
     return
 
 class Monitor(MyBaseThread):
-  def __init__(self, gld, src, fn, logger, qExcept, doit):
-    MyBaseThread.__init__(self, 'Mon(' + gld + ')', logger, qExcept)
-    self.gld = gld
+  def __init__(self, src, fn, logger, qExcept, historical):
+    MyBaseThread.__init__(self, 'Monitor', logger, qExcept)
     self.src = src
     self.fn = fn
-    self.doit = doit
+    self.historical = historical # glider -> Historical thread
+    # A plain int, so the per event test skips IntFlag's Python operators
+    self.mask = int(INotify.Flags.CLOSE_WRITE | INotify.Flags.ATTRIB | INotify.Flags.MOVED_TO)
 
   def runMain(self): # Called on thread start
-    src = os.path.join(self.src, self.gld, 'to-glider')
-    if not os.path.isdir(src):
-      raise Exception('Source "' + src + '" is not a directory')
+    # One inotify instance watches every glider's to-glider directory
+    inotify = INotify.INotify(self.logger)
+    # CREATE for recursion, DELETE, DELETE_SELF, and MOVED_FROM to drop removed directories' watches
+    Flags = INotify.Flags
+    mask = self.mask | Flags.CREATE | Flags.DELETE | Flags.DELETE_SELF | Flags.MOVED_FROM
+    for gld in self.historical:
+      src = os.path.join(self.src, gld, 'to-glider')
+      if not os.path.isdir(src):
+        raise Exception('Source "' + src + '" is not a directory')
+      self.logger.info('Starting %s', src)
+      inotify.add(src, recursive=True, mask=mask)
+
+    files = self.fn # Already a frozenset
+    self.logger.info('Files=%s', str(files))
+    nSrc = len(os.path.join(self.src, '')) # Length of src with a trailing separator
 
-    self.logger.info('Starting %s', src)
+    inotify.start()
 
-    files = set()
-    for fn in self.fn:
-      files.add(fn)
-    self.logger.info('Files=%s', str(files))
+    qDebug = self.logger.isEnabledFor(logging.DEBUG) # Skip per event debug calls when not needed
+    while inotify.is_alive():
+      evt = inotify.get()
+      inotify.task_done()
+      if not (evt.mask & self.mask): # Only here for directory recursion
+        continue
+      fn = evt.path.rpartition(os.sep)[2] # Filename to consider
+      if fn not in files: # Not a file of interest
+        if qDebug: self.logger.debug('%s is not in files list', evt.path)
+        continue
+      gld = evt.path[nSrc:].split(os.sep, 1)[0] # src/glider/to-glider/...
+      if qDebug: self.logger.debug('file %s glider %s file %s', evt.path, gld, fn)
+      self.historical[gld].put((time.time(), gld))
 
-    cmd = ['/usr/bin/inotifywait', \
-		'--monitor', \
-		'--quiet', \
-		'--recursive', \
-		'--event', 'close_write', \
-		'--event', 'attrib', \
-		'--event', 'moved_to', \
-		'--format', '%w%f', \
-                src]
-
-    self.logger.debug('cmd %s', ' '.join(cmd))
-
-    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
-      while True:
-        line = proc.stdout.readline()
-        if line == '' and proc.poll() is not None:
-          raise Exception('inotifywait failed, ' + str(cmd))
-        if not line:
-          self.logger.warn('empty line')
-          continue
-        line = str(line.strip(), 'utf-8')
-        fn = os.path.basename(line) # Filename to consider
-        if fn not in files: # Not a file of interest
-          self.logger.debug('%s is not in files list', line)
-          continue
-        self.logger.debug('file %s glider %s file %s', line, self.gld, fn)
-        self.doit.put((time.time(), self.gld))
+    raise Exception('INotify thread exited for ' + self.src)
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--gliders', action='append', required=True, help='List of gliders to process')
@@ -192,6 +211,7 @@ parser.add_argument('--delay', type=int, default=10, help='How many logfiles to
 parser.add_argument('--verbosity', default='ERROR', \
                     help='Logging verbosity level ERROR|WARN|INFO|DEBUG')
 args = parser.parse_args()
+args.fn = frozenset(args.fn) # Fast membership tests in Monitor
 
 logger = logging.getLogger(__name__)
 logger.setLevel(args.verbosity)
@@ -214,13 +234,16 @@ try:
   excQueue = queue.Queue() # Where thread exceptions are sent
 
   threads = []
+  historical = {}
   for gld in args.gliders:
-    thrH = Historical(gld, logger, excQueue, args)
-    thrH.start()
-    thrM = Monitor(gld, args.src, args.fn, logger, excQueue, thrH)
-    thrM.start()
-    threads.append(thrH)
-    threads.append(thrM)
+    thr = Historical(gld, logger, excQueue, args)
+    thr.start()
+    historical[gld] = thr
+    threads.append(thr)
+
+  thr = Monitor(args.src, args.fn, logger, excQueue, historical)
+  thr.start()
+  threads.append(thr)
 
   e = excQueue.get() # Wait for an exception from a thread
   raise(e)
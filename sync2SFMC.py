@@ -1,6 +1,6 @@
 #! /usr/bin/env python3
 #
-# Monitor a directory recursively for updates using inotifywait.
+# Monitor the glider directories in a directory for updates using inotify.
 # The directory structure below src is expected to be
 #   glider/file
 #
@@ -25,10 +25,33 @@ import queue
 import subprocess
 import getpass
 import socket
-import re
 import io
 import smtplib
+import errno
 from email.message import EmailMessage
+from SPSCQueue import SPSCQueue
+import INotify
+from RSync import RSync
+
+# errnos meaning O_TMPFILE or linking it through /proc does not work here, anything else is a real error
+tmpFileErrnos = frozenset((errno.EOPNOTSUPP, errno.EISDIR, errno.EXDEV, errno.ENOENT))
+
+def sendAll(ofd, ifd, size): # Copy size bytes from the start of ifd to ofd inside the kernel
+  offset = 0
+  while offset < size:
+    n = os.sendfile(ofd, ifd, offset, size - offset)
+    if n == 0: # ifd was truncated
+      break
+    offset += n
+
+def qBArgName(name): # Is name of the form identifier(units)? name comes from split, so has no whitespace
+  i = name.find('(')
+  if i <= 0 or not name.endswith(')'):
+    return False
+  ident = name[:i]
+  units = name[(i+1):-1]
+  return ident.isascii() and ident.isidentifier() \
+          and units != '' and '(' not in units and ')' not in units
 
 class MyBaseThread(threading.Thread):
   def __init__(self, name, logger, qExcept):
@@ -49,92 +72,152 @@ class MyBaseThread(threading.Thread):
     raise Exception('runMain not overridden by derived class')
 
 class Monitor(MyBaseThread):
-  def __init__(self, src, fn, logger, qExcept, doit):
+  def __init__(self, srcs, fn, logger, qExcept, doit):
     MyBaseThread.__init__(self, 'Monitor', logger, qExcept)
-    self.src = src
+    self.srcs = srcs
     self.fn = fn
     self.doit = doit
 
   def runMain(self): # Called on thread start
-    src = self.src
-    if not os.path.isdir(src):
-      raise Exception('Source "' + src + '" is not a directory')
-
-    self.logger.info('Starting %s: %s', self.src, str(self.fn))
-
     files = set()
     for fn in self.fn:
       files.add(fn)
     self.logger.info(files)
 
-    cmd = ['/usr/bin/inotifywait', \
-		'--monitor', \
-		'--quiet', \
-		'--recursive', \
-		'--event', 'close_write', \
-		'--event', 'attrib', \
-		'--event', 'moved_to', \
-		'--format', '%w%f', \
-                self.src]
-
-    self.logger.debug('cmd %s', ' '.join(cmd))
-
-    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
-      while True:
-        line = proc.stdout.readline()
-        if line == '' and proc.poll() is not None:
-          raise Exception('inotifywait failed, ' + str(cmd))
-        if not line:
-          self.logger.warn('empty line')
-          continue
-        line = str(line.strip(), 'utf-8')
-        fn = os.path.basename(line) # Filename to consider
-        if fn not in files: # Not a file of interest
-          self.logger.warn('%s is not in files list', line)
-          continue
-        prefix = os.path.dirname(line)
-        if os.path.dirname(prefix) != self.src:
-          self.logger.warn('Invalid directory structure for %s', line)
-          continue
-        gld = os.path.basename(prefix)
-        self.logger.debug('file %s glider %s file %s', line, gld, fn)
-        self.doit.put((time.time(), line, gld, fn))
+    # One inotify instance watches every src.
+    # Only watch the glider directories, not the whole tree below each src.
+    # src itself is watched for new glider directories.
+    Flags = INotify.Flags
+    mask = Flags.CLOSE_WRITE | Flags.ATTRIB | Flags.MOVED_TO
+    # Plain ints for the per event tests, so they skip IntFlag's Python operators
+    accept = int(mask | Flags.CREATE)
+    isDir = int(Flags.ISDIR)
+    added = int(Flags.CREATE | Flags.MOVED_TO)
+    inotify = INotify.INotify(self.logger)
+    srcs = set()
+    for src in self.srcs:
+      if not os.path.isdir(src):
+        raise Exception('Source "' + src + '" is not a directory')
+      self.logger.info('Starting %s: %s', src, str(self.fn))
+      # DELETE and MOVED_FROM let INotify drop a removed glider directory's watch
+      inotify.add(src, recursive=False,
+          mask=mask | Flags.CREATE | Flags.DELETE | Flags.MOVED_FROM)
+      with os.scandir(src) as it:
+        for entry in it:
+          if entry.is_dir():
+            inotify.add(entry.path, recursive=False, mask=mask)
+      srcs.add(src)
+    inotify.start()
+
+    qDebug = self.logger.isEnabledFor(logging.DEBUG) # Skip per event debug calls when not needed
+    while inotify.is_alive():
+      evt = inotify.get()
+      inotify.task_done()
+      if not (evt.mask & accept): # IGNORED, ...
+        continue
+      path = evt.path
+      (prefix, sep, fn) = path.rpartition(os.sep) # One split instead of dirname and basename
+      if prefix in srcs: # Something changed directly in a src
+        if (evt.mask & isDir) and (evt.mask & added):
+          self.logger.info('New glider directory %s', path)
+          inotify.add(path, recursive=False, mask=mask)
+        continue
+      if fn not in files: # Not a file of interest
+        self.logger.warn('%s is not in files list', path)
+        continue
+      gld = prefix.rpartition(os.sep)[2]
+      if qDebug: self.logger.debug('file %s glider %s file %s', path, gld, fn)
+      self.doit.put((evt.t, path, gld, fn))
+
+    raise Exception('INotify thread exited for ' + ', '.join(self.srcs))
+
+class Mailer(MyBaseThread):
+  def __init__(self, logger, qExcept, args):
+    MyBaseThread.__init__(self, 'Mailer', logger, qExcept)
+    self.mailHost = args.mailHost
+    self.idle = max(1, args.mailIdle) # Seconds to keep an unused connection open
+    self.queue = SPSCQueue() # runMain is the only consumer
+
+  def put(self, msg):
+    self.queue.put(msg)
+
+  def runMain(self): # Called on thread start
+    q = self.queue
+    self.logger.info('Starting')
+    s = None # SMTP connection, opened when there is something to send
+    while True:
+      try:
+        msg = q.get(timeout=None if s is None else self.idle)
+      except queue.Empty: # Nothing to send for a while, so close the connection
+        try:
+          s.quit()
+        except smtplib.SMTPException:
+          pass
+        s = None
+        continue
+      for attempt in range(2): # Retry once when a kept open connection was dropped
+        try:
+          if s is None:
+            s = smtplib.SMTP(self.mailHost)
+          s.send_message(msg)
+          break
+        except smtplib.SMTPServerDisconnected:
+          s = None
+          if attempt:
+            self.logger.exception('Unable to send %s', msg['Subject'])
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+          self.logger.exception('Unable to send %s', msg['Subject'])
+          break # Only this message was refused, so keep the connection
+        except (smtplib.SMTPException, OSError):
+          self.logger.exception('Unable to send %s', msg['Subject'])
+          if s is not None:
+            s.close()
+          s = None
+          break
+      q.task_done()
 
-class LineIO: # Iterable class of lines
+class LineIO: # Iterable class of lines, with the <start:x>...<end:x> sections located
   def __init__(self, lines):
-    self.index = 0 # Next index to read
     self.lines = []
+    self.sections = {} # name -> (start index, end index) of the last complete section
+    self.ends = {} # start index -> end index for every complete section
     if lines is None:
       return
+    opened = None # (name, index) of the section being scanned
     for line in lines:
       index = line.find('#') # Find a comment character
       if index >= 0:
          line = line[0:index] # Drop off trailing comment
       line = line.strip()
-      if line: # non-empty line, so append
-        self.lines.append(line)
+      if not line: # Skip empty lines
+        continue
+      if line.startswith('<start:') and line.endswith('>'):
+        opened = (line[7:-1], len(self.lines))
+      elif line.startswith('<end:') and line.endswith('>'):
+        if opened is not None and opened[0] == line[5:-1]:
+          self.sections[opened[0]] = (opened[1], len(self.lines))
+          self.ends[opened[1]] = len(self.lines)
+        opened = None
+      self.lines.append(line)
 
   def __iter__(self):
-    return self;
-
-  def __next__(self):
-    if self.index < len(self.lines): # something to return
-      self.index = self.index + 1
-      return self.lines[self.index - 1]
-    raise StopIteration
-    
+    return iter(self.lines)
+
 class Doit(MyBaseThread):
-  def __init__(self, logger, qExcept, args):
+  def __init__(self, logger, qExcept, args, mailer):
     MyBaseThread.__init__(self, 'Doit', logger, qExcept)
     self.archiveDir = args.archive
     self.tgt = args.tgt
     self.qDryrun = args.dryrun
+    self.rsyncPrefix = ('/usr/bin/rsync', '--quiet', '--archive', '--delay-updates') \
+        + RSync.rshArgs(args.controlPath, args.controlPersist) # Built once
     self.delay = args.delay
     self.notify = args.notify
     self.mailFrom = args.mailFrom
-    self.mailHost = args.mailHost
-    self.queue = queue.Queue()
-    self.bargPattern = re.compile("^\w+(\w+)$", flags=re.ASCII)
+    self.mailer = mailer
+    self.queue = SPSCQueue() # runMain is the only consumer
+    self.knownDirs = set() # Archive directories known to exist
+    self.qTmpFile = hasattr(os, 'O_TMPFILE') # Cleared if O_TMPFILE files can not be linked
 
   def put(self, a):
     self.queue.put(a)
@@ -142,47 +225,94 @@ class Doit(MyBaseThread):
   def runMain(self): # Called on thread start
     q = self.queue
     self.logger.info('Starting')
-    history = {}
     delay = self.delay
     if delay <= 0:
       delay = 0.1
 
+    stack = {} # Updated files waiting for things to settle, src -> (t, gld, fn)
+    tRef = None # When to process the stack
+
     while True:
-      (t, src, gld, fn) = q.get()
-      q.task_done()
-      if src in history and (t <= (history[src] + delay)): # Ignore quick updates
-        continue
-      history[src] = t
-      time.sleep(delay) # Wait a bit for everything to settle
-      (lines, afn) = self.archiveFile(t, src, gld, fn)
-      if lines is None: # Unable to open the file
-        continue
-      if not self.qSane(lines, afn):
-        continue
-      self.logger.debug('afn=%s\n', afn)
-      self.syncit(afn, os.path.join(self.tgt, gld, 'to-glider', fn))
-      if args.notify:
-        self.notifier(lines.lines, fn, gld)
+      try:
+        dt = None if tRef is None else max(0.001, tRef - time.time())
+        (t, src, gld, fn) = q.get(timeout=dt)
+        q.task_done()
+        stack[src] = (t, gld, fn) # Updates to the same file within delay are collapsed
+        if tRef is None:
+          tRef = t + delay # Wait a bit for everything to settle
+      except queue.Empty:
+        for (src, (t, gld, fn)) in stack.items():
+          self.process(t, src, gld, fn)
+        stack = {}
+        tRef = None
+
+  def process(self, t, src, gld, fn):
+    (lines, afn) = self.archiveFile(t, src, gld, fn)
+    if lines is None: # Unable to open the file
+      return
+    if not self.qSane(lines, afn):
+      return
+    self.logger.debug('afn=%s\n', afn)
+    self.syncit(afn, os.path.join(self.tgt, gld, 'to-glider', fn))
+    if args.notify:
+      self.notifier(lines, fn, gld)
 
   def archiveFile(self, t, src, gld, fn):
     adir = os.path.join(self.archiveDir, gld)
-    if not os.path.isdir(adir):
-      os.makedirs(adir)
+    if adir not in self.knownDirs: # Only stat/create the first time a glider is seen
+      os.makedirs(adir, exist_ok=True)
+      self.knownDirs.add(adir)
     afn = os.path.join(adir, str(time.strftime("%Y%m%d.%H%M%S.")) + os.path.basename(fn))
     try:
-      ifp = open(src, 'r')
+      ifd = os.open(src, os.O_RDONLY)
     except FileNotFoundError as e:
       self.logger.error("Error opening %s for reading", src)
       return (None, afn)
-    lines = []
-    with open(afn, 'w') as ofp, ifp:
-      lines = ifp.readlines()
-      ofp.writelines(lines)
+    with open(ifd, 'r') as ifp: # Closes ifd
+      self.createFile(afn, ifd, os.fstat(ifd).st_size) # Archive the bytes as is
+      lines = LineIO(ifp) # sendfile does not move ifd's offset, so this reads from the start
     os.remove(src)
     self.logger.info('Copied and removed %s to %s', src, afn)
-    return (LineIO(lines), afn)
+    return (lines, afn)
 
 
+  def createFile(self, path, ifd, size): # Create path holding ifd's bytes, never partially written
+    dirname = os.path.dirname(path)
+    tmp = os.path.join(dirname, '.' + os.path.basename(path) + '.tmp')
+    if self.qTmpFile:
+      try:
+        ofd = os.open(dirname, os.O_TMPFILE | os.O_WRONLY, 0o666) # Anonymous file in dirname
+      except OSError as e:
+        if e.errno not in tmpFileErrnos: raise
+        self.noTmpFile(e)
+      else:
+        try:
+          sendAll(ofd, ifd, size) # Real I/O errors propagate
+          # linkat(AT_SYMLINK_FOLLOW) of /proc/self/fd is how an O_TMPFILE file is given a name
+          proc = '/proc/self/fd/{}'.format(ofd)
+          try:
+            try:
+              os.link(proc, path)
+            except FileExistsError: # Replace the existing file atomically
+              os.link(proc, tmp)
+              os.rename(tmp, path)
+            return
+          except OSError as e:
+            if e.errno not in tmpFileErrnos: raise
+            self.noTmpFile(e)
+        finally:
+          os.close(ofd)
+    ofd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+      sendAll(ofd, ifd, size)
+    finally:
+      os.close(ofd)
+    os.rename(tmp, path) # Atomically publish the new file
+
+  def noTmpFile(self, e): # O_TMPFILE is not supported by this filesystem, or /proc is not usable
+    self.logger.info('Not using O_TMPFILE, %s', e)
+    self.qTmpFile = False
+
   def qSane(self, lines, fn):
     for line in lines:
       if line == "behavior_name=goto_list": # Must be first non-blank line
@@ -193,42 +323,46 @@ class Doit(MyBaseThread):
     return False
 
   def qSaneGoto(self, lines, fn):
-    bargs = None
+    bargs = {}
     waypts = -1
-    for line in lines:
+    ends = lines.ends
+    body = lines.lines
+    i = 1 # Skip the behavior_name line
+    while i < len(body):
+      line = body[i]
       if line == "<start:b_arg>":
-        bargs = self.qSaneBArg(lines, fn)
+        if i not in ends:
+          self.logger.error('No <end:b_arg> found for %s', fn)
+          return False
+        bargs = self.qSaneBArg(body[(i+1):ends[i]], fn)
         if not bargs:
           return False
       elif line == "<start:waypoints>":
-        waypts = self.qSaneWaypoints(lines, fn)
+        if i not in ends:
+          self.logger.error('No <end:waypoints> found in %s', fn)
+          return False
+        waypts = self.qSaneWaypoints(body[(i+1):ends[i]], fn)
         if waypts is None:
           return False
       else:
         self.logger.error('Unsupported line "%s" in %s', line, fn)
         return False
-    if 'num_waypoints(nodim)' not in bargs:
+      i = ends[i] + 1 # Continue after the section
+    nw = bargs.get('num_waypoints(nodim)')
+    if nw is None:
       self.logger.error('num_waypoints(nodim) not in %s', fn);
       return False
-    if bargs['num_waypoints(nodim)'] != waypts:
-      self.logger.error('num_waypoints(nodim) (%s) and number of waypoints (%s) do not match in %s', bargs['num_waypoints(nodim)'], waypts, fn)
+    if nw != waypts:
+      self.logger.error('num_waypoints(nodim) (%s) and number of waypoints (%s) do not match in %s', nw, waypts, fn)
       return False
-    if bargs['num_waypoints(nodim)'] > 8:
-      self.logger.error('num_waypoints(nodim) (%s) must be 8 or less in %s', bargs['num_waypoints(nodim)'], fn)
-      return False
-    if bargs['num_waypoints(nodim)'] < 1:
-      self.logger.error('num_waypoints(nodim) (%s) must be >= 1 in %s', bargs['num_waypoints(nodim)'], fn)
-      return False
-    if bargs['num_waypoints(nodim)'] > 8:
-      self.logger.error('num_waypoints(nodim) (%s) must be <= 8 in %s', bargs['num_waypoints(nodim)'], fn)
+    if not (1 <= nw <= 8):
+      self.logger.error('num_waypoints(nodim) (%s) must be between 1 and 8 in %s', nw, fn)
       return False
     return True
 
-  def qSaneBArg(self, lines, fn):
+  def qSaneBArg(self, lines, fn): # lines are the ones between <start:b_arg> and <end:b_arg>
     info = {}
     for line in lines:
-      if line == "<end:b_arg>":
-         return info
       fields = line.split()
       if len(fields) != 3:
         self.logger.error('Line "%s" does not have three fields', line)
@@ -236,7 +370,7 @@ class Doit(MyBaseThread):
       if fields[0] != 'b_arg:':
         self.logger.error('Line "%s" does not begin with b_arg:', line)
         return {}
-      if re.match(self.bargPattern, fields[1]):
+      if not qBArgName(fields[1]):
         self.logger.error('Variable in "%s" is not formated properly', line)
         return {}
       try:
@@ -245,27 +379,23 @@ class Doit(MyBaseThread):
       except ValueError:
         self.logger.error('Third field in "%s" is not numeric', line)
         return {}
-   
-    self.logger.error('No <end:b_arg> found for %s', fn)
-    return {}
+    return info
 
-  def qSaneWaypoints(self, lines, fn):
+  def qSaneWaypoints(self, lines, fn): # lines are the ones between the waypoints markers
     count = 0
     for line in lines:
-      if not line:
-        continue
-      if line == "<end:waypoints>":
-        if count > 0:
-          return count
-        self.logger.error('No waypoints found in %s', fn)
-        return None
       fields = line.split()
       if len(fields) != 2:
         self.logger.error('Line "%s" in %s does not have two fields', line, fn)
-        return {}
+        return None
       try:
         lon = float(fields[0])
         lat = float(fields[1])
+        if (-18000 <= lon <= 18000) and (-9000 <= lat <= 9000) and \
+            ((abs(lon) % 100) < 60) and ((abs(lat) % 100) < 60): # The common, good, case
+          count += 1
+          continue
+        # Something is wrong, so work out what to report
         if lon < -18000 or lon > 18000:
           self.logger.error('Longitude(%s) is out of range in %s', line, fn)
           return None
@@ -278,17 +408,22 @@ class Doit(MyBaseThread):
         if (abs(lat) % 100) >= 60:
           self.logger.error('Latitude(%s) minutes are out of range in %s', line, fn)
           return None
-        count += 1
+        self.logger.error('Position(%s) is not a number in %s', line, fn) # NaN
+        return None
       except ValueError:
         self.logger.error('Unable to convert "%s" into a pair of numbers in %s', line, fn)
         return None
-     
-    self.logger.error('No <end:waypoints> found in %s', fn)
+    if count > 0:
+      return count
+    self.logger.error('No waypoints found in %s', fn)
     return None
 
   def syncit(self, src, tgt):
-    cmd = ['/usr/bin/rsync', '--quiet', '--archive', '--delay-updates', src, tgt]
-    self.logger.debug(' '.join(cmd))
+    if ':' not in tgt: # A local target, so copy it without forking rsync
+      return self.copyLocal(src, tgt)
+    cmd = [*self.rsyncPrefix, src, tgt]
+    if self.logger.isEnabledFor(logging.DEBUG): # Skip the join when not logging it
+      self.logger.debug('%s', ' '.join(cmd))
     if self.qDryrun:
       self.logger.info('Not syncing %s to %s due to dryrun', src, tgt)
       return True
@@ -299,25 +434,42 @@ class Doit(MyBaseThread):
     self.logger.error('Error syncing %s to %s\n, %s', src, tgt, str(p.stdout, 'utf-8'))
     return False 
 
+  def copyLocal(self, src, tgt): # Like rsync --archive --delay-updates for a single local file
+    if self.qDryrun:
+      self.logger.info('Not copying %s to %s due to dryrun', src, tgt)
+      return True
+    tmp = os.path.join(os.path.dirname(tgt), '.' + os.path.basename(tgt) + '.tmp')
+    try:
+      ifd = os.open(src, os.O_RDONLY)
+      try:
+        st = os.fstat(ifd)
+        ofd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+          sendAll(ofd, ifd, st.st_size)
+          os.fchmod(ofd, st.st_mode & 0o7777)
+          os.fsync(ofd)
+        finally:
+          os.close(ofd)
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+      finally:
+        os.close(ifd)
+      os.rename(tmp, tgt) # Atomically publish the new file
+    except OSError as e:
+      self.logger.error('Error copying %s to %s, %s', src, tgt, e)
+      if os.path.exists(tmp):
+        os.unlink(tmp)
+      return False
+    self.logger.info('Copied %s to %s', src, tgt)
+    return True
+
   def notifier(self, lines, fn, gld):
     msg = EmailMessage()
     msg['Subject'] = "{} {}".format(gld, fn)
     msg['From'] = self.mailFrom
     msg['To'] = self.notify
-    a = []
-    state = 0
-    for line in lines:
-      if state == 0 and line == '<start:waypoints>':
-        state = 1
-      elif state == 1:
-        if line == '<end:waypoints>':
-          state == 0
-        else:
-          a.append(line)
-    msg.set_content('\n'.join(a))
-    s = smtplib.SMTP(self.mailHost)
-    s.send_message(msg)
-    s.quit()
+    (start, end) = lines.sections['waypoints'] # qSane made sure it exists
+    msg.set_content('\n'.join(lines.lines[(start+1):end]))
+    self.mailer.put(msg) # Sent from the Mailer thread, so SMTP never blocks Doit
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--src', help='Source directory to monitor', required=True, action='append')
@@ -329,11 +481,14 @@ parser.add_argument('--maxlogsize', default=10000000, type=int, \
 			help='How large to let the log file grow to')
 parser.add_argument('--backupcount', default=5, type=int, help='How many logfiles to keep')
 parser.add_argument('--delay', default=10, type=int, help='How many logfiles to keep')
+RSync.addControlArgs(parser, '--controlPath', '--controlPersist')
 parser.add_argument('--dryrun', help='Do not actually copy the files', action='store_true')
 parser.add_argument('--verbosity', help='Logging verbosity level ERROR|WARN|INFO|DEBUG', default='ERROR')
 parser.add_argument('--notify', help='Who to mail notifications to', action='append')
 parser.add_argument('--mailTo', help='Who to mail errors to', action='append')
 parser.add_argument('--mailHost', help='SMTP hostname', default='localhost')
+parser.add_argument('--mailIdle', default=60, type=float,
+                    help='Seconds to keep an idle notification SMTP connection open')
 parser.add_argument('--mailFrom', help='Who mail is coming from',
                     default=getpass.getuser() + '@' + socket.gethostname())
 parser.add_argument('--mailSubject', help='Subject of mail',
@@ -366,15 +521,14 @@ try:
 
   excQueue = queue.Queue() # Where thread exceptions are sent
 
-  thrDoit = Doit(logger, excQueue, args)
-  thrDoit.start()
+  thrMailer = Mailer(logger, excQueue, args)
+  thrMailer.start()
 
-  threads = []
+  thrDoit = Doit(logger, excQueue, args, thrMailer)
+  thrDoit.start()
 
-  for src in args.src:
-    thr = Monitor(src, args.fn, logger, excQueue, thrDoit)
-    thr.start()
-    threads.append(thr)
+  thrMonitor = Monitor(args.src, args.fn, logger, excQueue, thrDoit) # Watches every src
+  thrMonitor.start()
 
   e = excQueue.get() # Wait for an exception from a thread
   excQueue.task_done()
@@ -22,6 +22,9 @@ import queue
 import subprocess
 import getpass
 import socket
+from SPSCQueue import SPSCQueue
+import INotify
+from RSync import RSync
 
 class MyBaseThread(threading.Thread):
   def __init__(self, name, logger, qExcept):
@@ -43,10 +46,9 @@ class MyBaseThread(threading.Thread):
 
   
 class Monitor(MyBaseThread):
-  def __init__(self, args, src, logger, qExcept, syncer):
-    MyBaseThread.__init__(self, 'Mon.{}'.format(src), logger, qExcept)
+  def __init__(self, args, logger, qExcept, syncer):
+    MyBaseThread.__init__(self, 'Monitor', logger, qExcept)
     self.args = args
-    self.src = src
     self.syncer = syncer
 
   def runMain(self): # Called on thread start
@@ -54,38 +56,64 @@ class Monitor(MyBaseThread):
     syncer = self.syncer
     logger = self.logger
 
-    rootDir = os.path.join(args.prefix, self.src, args.suffix)
-
-    logger.info('Starting: %s', rootDir)
-
-    cmd = [self.args.inotifywait, '--monitor', '--quiet', '--recursive', '--format', '%w', \
-          '--event', 'close_write', \
-          '--event', 'attrib', \
-          '--event', 'move', \
-          rootDir]
-
-    logger.debug(' '.join(cmd))
-
-    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc: # Incase of exception
-      if not args.noInitial: # Do after we start the subprocess, so hopefully we won't miss updates
-        syncer.put((time.time(), rootDir))
-      while True:
-        line = proc.stdout.readline()
-        if line == '' and proc.poll() is not None:
-          raise Exception('inotifywait failed, ' + ' '.join(cmd))
-        if not line:
-          continue
-        line = str(line.rstrip(b"\n/"), 'utf-8')
-        src = line
-        tgt = []
-        logger.debug('Line "%s"', line)
-        syncer.put((time.time(), line))
+    # The cache directories are flat, so only they are watched, not a tree,
+    # and only for events which mean a file is ready to be copied.
+    # One inotify instance watches every src.
+    mask = INotify.Flags.CLOSE_WRITE | INotify.Flags.ATTRIB | INotify.Flags.MOVED_TO
+    accept = int(mask) # A plain int, so the per event test skips IntFlag's Python operators
+    inotify = INotify.INotify(logger)
+    rootDirs = {} # cache directory -> src, in the order given
+    for src in args.src:
+      rootDir = os.path.join(args.prefix, src, args.suffix)
+      if not os.path.isdir(rootDir):
+        raise Exception('Source "' + rootDir + '" is not a directory')
+      logger.info('Starting: %s', rootDir)
+      inotify.add(rootDir, recursive=False, mask=mask)
+      rootDirs[rootDir] = src
+    inotify.start()
+
+    if not args.noInitial: # Do after the watches are added, so hopefully we won't miss updates
+      t = time.monotonic()
+      for rootDir in rootDirs:
+        syncer.put((t, rootDir, None)) # None means the whole directory
+
+    qDebug = logger.isEnabledFor(logging.DEBUG)
+    while inotify.is_alive():
+      evt = inotify.get()
+      pending = {} # rootDir -> (time of its first event, names), for a burst of queued events
+      while evt is not None:
+        inotify.task_done()
+        if evt.mask & accept: # Not IGNORED, ...
+          (rootDir, sep, name) = evt.path.rpartition(os.sep) # Which cache directory and file
+          if rootDir in rootDirs:
+            if qDebug: logger.debug('Event %s', evt)
+            if rootDir not in pending:
+              pending[rootDir] = (time.monotonic(), set())
+            pending[rootDir][1].add(name)
+        try:
+          evt = inotify.get_nowait()
+        except queue.Empty:
+          evt = None
+      for (rootDir, (t, names)) in pending.items(): # One item per directory, not one per event
+        syncer.put((t, rootDir, names))
+
+    raise Exception('INotify thread exited for ' + ', '.join(rootDirs))
 
 class Syncer(MyBaseThread):
   def __init__(self, logger, qExcept, args):
     MyBaseThread.__init__(self, 'Syncer', logger, qExcept)
     self.args = args
-    self.queue = queue.Queue()
+    self.queue = SPSCQueue() # runMain is the only consumer
+    self.cmdPrefix = self.mkCmdPrefix(args) # args does not change, so build once
+
+  @staticmethod
+  def mkCmdPrefix(args):
+    cmd = [args.rsync, \
+	   '--archive', \
+	   '--delay-updates', \
+	   '--chmod=' + args.chmod]
+    cmd.extend(RSync.rshArgs(args.controlPath, args.controlPersist))
+    return tuple(cmd)
 
   def put(self, a): # Put things in my queue, called by MonitorGMC
     self.queue.put(a)
@@ -95,40 +123,67 @@ class Syncer(MyBaseThread):
     logger = self.logger
     q = self.queue
     logger.info('Starting %s', self.args.tgt)
-    prevTime = {}
+    stack = {} # Directory -> updated names, or None for all of it, in the order they were updated
+    tRef = None # When to sync the stack, on the monotonic clock so clock steps do not matter
 
     while True:
-      (t, src) = q.get()
-      logger.debug('t=%s src=%s', t, src)
-      q.task_done()
-      if src in prevTime and t < prevTime[src]: # Skip recent updates
-        continue
-      logger.debug('delay=%s for src=%s', args.delay, src)
-      time.sleep(args.delay)
-      prevTime[src] = t + args.delay
-      self.syncit(src)
-
-  def syncit(self, src):
+      try:
+        dt = None if tRef is None else max(0.001, tRef - time.monotonic())
+        (t, src, names) = q.get(timeout=dt)
+        logger.debug('t=%s src=%s', t, src)
+        q.task_done()
+        if names is None: # The whole directory
+          stack[src] = None
+        elif src not in stack:
+          stack[src] = set(names)
+        elif stack[src] is not None:
+          stack[src].update(names)
+        if tRef is None:
+          logger.debug('delay=%s for src=%s', args.delay, src)
+          tRef = t + args.delay
+      except queue.Empty: # Nothing new for a while, so sync everything
+        self.syncit(stack)
+        stack = {}
+        tRef = None
+
+  def syncit(self, stack):
+    args = self.args
+    whole = tuple(src for (src, names) in stack.items() if names is None)
+    if whole: # One rsync for all the directories to be synced in full
+      self.rsync(whole, args.tgt, False)
+
+    targets = {} # Where rsync of a directory would put its files -> updated files
+    for (src, names) in stack.items():
+      if names is not None:
+        tgt = os.path.join(args.tgt, os.path.basename(src))
+        files = targets.setdefault(tgt, [])
+        files.extend(os.path.join(src, name) for name in sorted(names))
+    for (tgt, files) in targets.items(): # Normally one rsync, since the suffixes are the same
+      self.rsync(files, tgt, True)
+
+  def rsync(self, sources, tgt, qFiles):
     args = self.args
     logger = self.logger
-    tgt = args.tgt
-    cmd = [args.rsync, \
-	   '--archive', \
-	   '--delay-updates', \
-	   '--chmod=' + args.chmod, \
-           src, \
-           tgt]
+    cmd = list(self.cmdPrefix)
+    if qFiles: # Only copy the files listed on stdin, not the whole directory
+      cmd.extend(['--no-relative', '--ignore-missing-args', '--from0', '--files-from=-', '/', tgt + '/'])
+      stdin = b'\0'.join(os.fsencode(fn) for fn in sources)
+    else:
+      cmd.extend(sources)
+      cmd.append(tgt)
+      stdin = None
 
-    logger.debug(' '.join(cmd))
+    if logger.isEnabledFor(logging.DEBUG): # Skip the join when not logging it
+      logger.debug('%s', ' '.join(cmd))
     if args.dryrun:
-      logger.info('Not syncing %s to %s due to dryrun', src, tgt)
+      logger.info('Not syncing %s to %s due to dryrun', sources, tgt)
       return True
-    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    p = subprocess.run(cmd, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     if p.returncode == 0: # Success
-      logger.info('Synced %s to %s', src, tgt)
-    else:
-      logger.error('Error syncing %s to %s\n, %s', src, tgt, p.stdout)
-
+      logger.info('Synced %s to %s', sources, tgt)
+      return True
+    logger.error('Error syncing %s to %s\n, %s', sources, tgt, p.stdout)
+    return False
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--prefix', default='/var/opt/sfmc-dataserver/stations', 
@@ -147,8 +202,8 @@ parser.add_argument('--backupcount', default=5, type=int, help='How many logfile
 parser.add_argument('--chmod', default='Do+rx,Fo+r', help='chmod on rync command')
 parser.add_argument('--dryrun', help='Do not actually copy the files', action='store_true')
 parser.add_argument('--verbosity', help='Logging verbosity level ERROR|WARN|INFO|DEBUG', default='ERROR')
-parser.add_argument('--inotifywait', default='/usr/bin/inotifywait', help='inotifywait command to use')
 parser.add_argument('--rsync', default='/usr/bin/rsync', help='rsync command to use')
+RSync.addControlArgs(parser, '--controlPath', '--controlPersist')
 parser.add_argument('--noInitial', action='store_true', help='Do not do an initial sync')
 parser.add_argument('--mailTo', help='Who to mail errors to', action='append')
 parser.add_argument('--mailHost', help='SMTP hostname', default='localhost')
@@ -181,11 +236,8 @@ try:
   thrSyncer = Syncer(logger, qExcept, args)
   thrSyncer.start()
 
-  threads = []
-  for src in args.src:
-    thr = Monitor(args, src, logger, qExcept, thrSyncer)
-    thr.start()
-    threads.append(thr)
+  thrMonitor = Monitor(args, logger, qExcept, thrSyncer) # Watches every src
+  thrMonitor.start()
 
   e = qExcept.get() # Wait for an exception from a thread
   qExcept.task_done()
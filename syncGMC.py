@@ -27,55 +27,115 @@ import MyLogger
 import INotify
 from RSync import RSync
 
-def mkPath(path:str, args:argparse.ArgumentParser) -> str:
-    trigger = re.compile("(.*)(" + "|".join(args.trigger) + ")")
-    a = trigger.search(path)
+def mkAlternation(patterns:list) -> str:
+    """ One alternation of all the patterns, so a single search tests them all """
+    return "|".join("(?:" + item + ")" for item in patterns)
+
+def qLiteral(patterns:list) -> bool:
+    """ Are all the patterns plain strings, without any regular expression syntax?
+
+    A "." is taken literally, since patterns like /gliderState.xml are file names.
+    """
+    special = frozenset("^$*+?{}[]\\|()")
+    return not any(special.intersection(item) for item in patterns)
+
+def mkPatterns(args:argparse.ArgumentParser) -> tuple:
+    """ Build the trigger and exclude tests once, exclude is None if there are none
+
+    trigger(path) returns the part of path before the last trigger, or None
+    exclude(path) returns True if any exclude pattern is in path
+    Plain strings are tested with str methods, which are much faster than a regex.
+    In a plain string "." only matches a literal ".", not any character.
+    """
+    if qLiteral(args.trigger):
+        triggers = tuple(args.trigger)
+        def trigger(path:str) -> str: # Like the regex's greedy (.*), use the last occurrence
+            index = max(path.rfind(item) for item in triggers)
+            return None if index < 0 else path[:index]
+    else:
+        expr = re.compile("(.*)(" + mkAlternation(args.trigger) + ")")
+        def trigger(path:str) -> str:
+            a = expr.search(path)
+            return None if a is None else a[1]
+
+    if args.exclude is None:
+        exclude = None
+    elif qLiteral(args.exclude):
+        excludes = tuple(args.exclude)
+        exclude = lambda path: any(item in path for item in excludes)
+    else:
+        exclude = re.compile(mkAlternation(args.exclude)).search
+    return (trigger, exclude)
+
+def mkPrune(exclude):
+    """ Prune function for scanTree and INotify.add, so excluded trees are never walked """
+    if exclude is None: return None
+    return lambda path: exclude(path + os.sep)
+
+def mkPath(path:str, trigger, exclude) -> str:
+    a = trigger(path)
     if a is None: return None
 
-    if args.exclude is not None:
-        b = re.search("(" + "|".join(args.exclude) + ")", path)
-        if b is not None:
-            return None
-    return a[1]
+    if exclude is not None and exclude(path):
+        return None
+    return a
 
 def doit(args:argparse.ArgumentParser,
         logger:logging.Logger,
         inotify:INotify.INotify,
         rsync:RSync) -> None:
-    timeout = None
-    paths = set()
+    (trigger, exclude) = mkPatterns(args)
+    ignored = int(INotify.Flags.IGNORED) # A plain int, so the test skips IntFlag's Python operators
+    pending = {} # Path to sync -> when to sync it, args.delay after its first event, monotonic
 
     while inotify.is_alive(): # This should be forever
+        dt = None
+        if pending: # Each path has its own deadline, so a busy glider does not hold up the others
+            now = time.monotonic() # Not affected by NTP steps
+            due = {a for (a, t) in pending.items() if t <= now}
+            if due:
+                rsync.put(due)
+                for a in due: del pending[a]
+            if pending:
+                dt = max(0.001, min(pending.values()) - now)
+
         try:
-            dt = None if timeout is None else max(0.001, (timeout - time.time()))
             evt = inotify.get(timeout=dt)
-            inotify.task_done()
-
-            if evt.flags.IGNORED in evt.flags:
-                continue
-
-            a = mkPath(evt.path, args)
-            if a is None:
-                continue
-
-            paths.add(a if os.path.isdir(a) else os.path.dirname(a))
-            if timeout is None:
-                timeout = evt.t + args.delay # Time out in args.delay seconds from now
         except queue.Empty:
-            rsync.put(paths)
-            paths = set()
-            timeout = None
+            continue
+
+        deadline = time.monotonic() + args.delay # For paths first seen in this batch
+        while evt is not None: # Drain what is already queued without recomputing the timeout
+            inotify.task_done()
+            if not (evt.mask & ignored): # Watch removed, nothing to sync
+                a = mkPath(evt.path, trigger, exclude)
+                if a is not None:
+                    if a not in pending: # a is the directory above the trigger, so no stat
+                        pending[a] = deadline
+            try:
+                evt = inotify.get_nowait()
+            except queue.Empty:
+                evt = None
 
 def initialSync(args:argparse.ArgumentParser, rsync:RSync) -> None:
+    (trigger, exclude) = mkPatterns(args)
+    excluded = mkPrune(exclude)
     paths = set()
-    trigger = re.compile("(.*)(" + "|".join(args.trigger) + ")")
+
+    def prune(path:str) -> bool:
+        # Never walk excluded trees, like .archived-deployments
+        if excluded is not None and excluded(path):
+            return True
+        # Nor below a trigger directory, like from-glider, since its prefix is synced recursively
+        a = mkPath(path, trigger, exclude)
+        if a is None: return False
+        paths.add(a)
+        return True
+
     for path in args.dir:
-        for (root, dirs, files) in os.walk(path):
-            for name in dirs:
-                a = mkPath(os.path.join(root, name), args)
-                if a is not None: paths.add(a)
-            for name in files:
-                a = mkPath(os.path.join(root, name), args)
+        for entry in INotify.scanTree(path, prune):
+            if not entry.is_dir(follow_symlinks=False): # Directories were handled by prune
+                a = mkPath(entry.path, trigger, exclude)
                 if a is not None: paths.add(a)
     if len(paths):
         rsync.put(paths)
@@ -110,8 +170,9 @@ mask = INotify.Flags( \
             INotify.Flags.DELETE_SELF |
             INotify.Flags.CREATE) # For directory recursion
 
+prune = mkPrune(mkPatterns(args)[1]) # Don't watch excluded trees
 for path in args.dir:
-    inotify.add(path, recursive=True, mask=mask)
+    inotify.add(path, recursive=True, mask=mask, prune=prune)
 
 if not args.noInitial:
     initialSync(args, rsync) 